@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+''' benchmark the start up time of pfstarget in fresh python processes. 
+
+    python bin/benchmark_import.py 
+    python bin/benchmark_import.py --tract TRACT_FILE --dust sfd98 
+
+The "select tract" step reads the tract with astropy.io.fits, as
+bin/select_targets.py does, and is dominated by importing it, not by
+pfstarget itself. 
+'''
+import sys
+import time
+import subprocess
+
+from argparse import ArgumentParser
+ap = ArgumentParser(description='Benchmark import and start up time of pfstarget')
+ap.add_argument("--tract", type=str,
+                help='also time reading and selecting targets from this tract file',
+                default=None)
+ap.add_argument("--dust", type=str,
+                help='galactic extinction dust model used with --tract [defaults to sfd98]',
+                default='sfd98')
+ap.add_argument("--n", type=int,
+                help='number of repeats; the fastest is reported [defaults to 5]',
+                default=5)
+ns = ap.parse_args()
+
+heavy = ['astropy.io.fits', 'astropy.table', 'healpy']
+
+def _run(code): 
+    ''' run code in a fresh python process and return the wall time and the
+    heavy modules that were imported 
+    '''
+    code += "\nimport sys; print(','.join(m for m in %r if m in sys.modules))" % heavy 
+    t0 = time.perf_counter() 
+    out = subprocess.run([sys.executable, '-c', code], check=True, 
+                         capture_output=True, text=True).stdout
+    return time.perf_counter() - t0, out.strip().split('\n')[-1]
+
+benchmarks = [
+        ('python', 'pass'), 
+        ('numpy', 'import numpy'), 
+        ('pfstarget.cuts', 'import pfstarget.cuts'), 
+        ('pfstarget.extinction', 'import pfstarget.extinction'), 
+        ('pfstarget.util', 'import pfstarget.util'), 
+        ('pfstarget.catalog', 'import pfstarget.catalog'), 
+        ]
+if ns.tract is not None: 
+    benchmarks.append(('select tract', '\n'.join([
+        "from astropy.io import fits", 
+        "from pfstarget import cuts as Cuts", 
+        "tract = fits.getdata(%r)" % ns.tract, 
+        "_hsc = Cuts._prepare_hsc(tract, dust_extinction=%r)" % ns.dust, 
+        "targets = _hsc[Cuts.isCosmology(_hsc)]"])))
+
+for name, code in benchmarks: 
+    times, loaded = [], None
+    for i in range(ns.n): 
+        t, loaded = _run(code)
+        times.append(t) 
+    print('%-22s %8.3f s   [heavy modules: %s]' % (name, min(times), loaded or '-'))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+''' generate an SQL query with a conservative pre-filter derived from the PFS
+cosmology target selection (pfstarget.cuts.isCosmology) so that objects that
+can never be selected are not downloaded. 
+
+    python3 prefilter_sql.py s23b_wide_pfs.sql s23b_wide_pfs.prefilter.sql 
+    python3 hscReleaseQuery.py s23b_wide_pfs.prefilter.sql -D --user username -r s23
+
+The pre-filter can be checked offline against tract files downloaded without
+it with --verify. 
+'''
+import sys
+
+from argparse import ArgumentParser
+ap = ArgumentParser(description='Inject target selection pre-filter into an SQL template')
+ap.add_argument("template",
+                help="SQL template with a '-- {$prefilter}' placeholder")
+ap.add_argument("output",
+                help="output SQL file")
+ap.add_argument("--dmag", type=float,
+                help='margin on cuts on extinction corrected magnitudes [defaults to 0.5]',
+                default=0.5)
+ap.add_argument("--star_galaxy_cut", type=float, default=None)
+ap.add_argument("--magnitude_cut", type=float, default=None)
+ap.add_argument("--verify", type=str, nargs='+',
+                help='tract files (downloaded without the pre-filter) used to check '
+                'that the pre-filter does not change the selected targets',
+                default=None)
+ap.add_argument("--dust", type=str,
+                help='galactic extinction dust model used with --verify [defaults to desi dust map]',
+                default='desi')
+ns = ap.parse_args()
+
+from pfstarget import sql as S
+
+kwargs = {k: getattr(ns, k) for k in ['star_galaxy_cut', 'magnitude_cut'] 
+          if getattr(ns, k) is not None}
+
+with open(ns.template, 'r') as f: 
+    sql = f.read() 
+
+with open(ns.output, 'w') as f: 
+    f.write(S.inject_prefilter(sql, dmag=ns.dmag, **kwargs))
+
+if ns.verify is not None: 
+    from astropy.table import Table
+
+    nlost = 0 
+    for ftract in ns.verify: 
+        tract = Table.read(ftract) 
+        in_prefilter, _nlost = S.verify_prefilter(tract, dust_extinction=ns.dust, 
+                                                  dmag=ns.dmag, **kwargs)
+        print('%s: %i of %i objects pass the pre-filter, %i targets lost' % 
+              (ftract, in_prefilter.sum(), len(in_prefilter), _nlost))
+        nlost += _nlost
+    if nlost > 0: 
+        sys.exit(1)
@@ -325,4 +325,7 @@ WHERE
     AND NOT f1.r_pixelflags_crcenter
     AND NOT f1.i_pixelflags_crcenter
     AND NOT f1.z_pixelflags_crcenter
+
+    -- Pre-filter based on the target selection (see prefilter_sql.py) 
+    -- {$prefilter}
 ;
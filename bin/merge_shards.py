@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import os, sys
+import glob 
+import tempfile
+
+from pfstarget import catalog as C
+from pfstarget import util as U
+
+from argparse import ArgumentParser
+ap = ArgumentParser(description='Combine shard outputs of select_targets.py --shard')
+ap.add_argument("shards", nargs='+', 
+                help="shard output directories")
+ap.add_argument("dest",
+                help="Output target selection directory")
+ap.add_argument("--format", type=str, choices=['fits', 'npy'],
+                help='output format: single fits file or columnar .npy files '
+                'partitioned by healpix pixel [defaults to fits]',
+                default='fits')
+ap.add_argument("--nside", type=int,
+                help='healpix nside (power of 2) of the partitions for --format npy [defaults to 32]',
+                default=32)
+ns = ap.parse_args()
+
+# check the healpix nside before the shards are merged 
+U.check_nside(ns.nside, nside_max=U.HPX_NSIDE) 
+
+shard_dirs = sorted(set(sum([glob.glob(_shard) for _shard in ns.shards], [])))
+if len(shard_dirs) == 0:
+    raise ValueError("no shards found") 
+    sys.exit(1)
+
+manifest = C.read_manifest(shard_dirs[0]) 
+
+# output file names 
+fout, fmaps = C.target_filenames(ns.dest, manifest['dust'], format=ns.format, 
+                                 nside_map=manifest['nside_map'])
+
+# combine all targets removing objects that appear in more than one 
+# (overlapping) tract file 
+# the merged catalog is streamed to a temporary file next to the output 
+tmpdir = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(fout))) 
+targets, ndropped, randoms = C.merge_shards(shard_dirs, os.path.join(tmpdir.name, 'merged.npy')) 
+for name, n in ndropped.items(): 
+    if n > 0: print('%s: %i duplicate targets dropped' % (name, n))
+
+# write to file 
+C.write_targets(targets, fout, format=ns.format, nside=ns.nside) 
+C.write_healpix_maps(fmaps, targets, nside=manifest['nside_map'], randoms=randoms) 
+
+del targets
+tmpdir.cleanup()
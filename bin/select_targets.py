@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 import os, sys
 import glob 
+import tempfile
 import numpy as np
-from astropy.table import Table
+# astropy.io.fits is much faster to import than astropy.table 
+from astropy.io import fits
 
 from pfstarget import cuts as Cuts
 from pfstarget import extinction as E
+from pfstarget import catalog as C
+from pfstarget import util as U
 
 from argparse import ArgumentParser
 ap = ArgumentParser(description='Generate PFS targets from HSC tract files')
@@ -16,8 +20,31 @@ ap.add_argument("dest",
 ap.add_argument("--dust", type=str,
                 help='galactic extinction dust model [defaults to desi dust map]',
                 default='desi')
+ap.add_argument("--format", type=str, choices=['fits', 'npy'],
+                help='output format: single fits file or columnar .npy files '
+                'partitioned by healpix pixel [defaults to fits]',
+                default='fits')
+ap.add_argument("--nside", type=int,
+                help='healpix nside (power of 2) of the partitions for --format npy [defaults to 32]',
+                default=32)
+ap.add_argument("--nside_map", type=int,
+                help='healpix nside (power of 2) of the target count and effective area maps [defaults to 128]',
+                default=128)
+ap.add_argument("--randoms", type=str,
+                help='random file or directory with random files used for the effective area map',
+                default=None)
+ap.add_argument("--no_cache", action='store_true',
+                help='do not use the on-disk cache of extinction corrected magnitudes')
+ap.add_argument("--shard", type=str,
+                help='only process shard i of N (i/N) of the tract files and write '
+                'the shard output to be combined with bin/merge_shards.py',
+                default=None)
 ns = ap.parse_args()
 
+# check the healpix nsides before any tract is processed 
+for _nside in [ns.nside, ns.nside_map]: 
+    U.check_nside(_nside, nside_max=U.HPX_NSIDE) 
+
 infiles = [] 
 if os.path.isfile(ns.tractsdir): infiles = glob.glob(ns.tractsdir) 
 elif os.path.isdir(ns.tractsdir): infiles = glob.glob('%s/*' % ns.tractsdir) 
@@ -27,33 +54,86 @@ if len(infiles) == 0:
     raise ValueError("no tract files found") 
     sys.exit(1)
 
-# output file name 
-if os.path.isfile(ns.dest): 
-    fout = ns.dest
-elif os.path.isdir(ns.dest): 
-    fout = os.path.join(ns.dest, f'pfs_target.dust_{ns.dust}.fits') 
+ranfiles = None 
+if ns.randoms is not None: 
+    if os.path.isfile(ns.randoms): ranfiles = glob.glob(ns.randoms) 
+    elif os.path.isdir(ns.randoms): ranfiles = glob.glob('%s/*' % ns.randoms) 
+    else: raise ValueError("no random files found") 
+
+if ns.shard is None: 
+    ishard, nshard = 0, 1
+    # output file names 
+    fout, fmaps = C.target_filenames(ns.dest, ns.dust, format=ns.format,
+                                     nside_map=ns.nside_map)
+    # per-tract runs and the merged catalog are written to a temporary 
+    # directory next to the output (not $TMPDIR) 
+    tmpdir = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(fout))) 
+    shard_dir = tmpdir.name
 else: 
-    raise ValueError('specify output directory or filename')  
+    ishard, nshard = [int(_i) for _i in ns.shard.split('/')]
+    # files are split into shards balanced by file size 
+    infiles = U.shard_files(infiles, ishard, nshard) 
+    if ranfiles is not None: ranfiles = U.shard_files(ranfiles, ishard, nshard)
+
+    if not os.path.isdir(ns.dest): 
+        raise ValueError('specify output directory')  
+    shard_dir = os.path.join(ns.dest, f'pfs_target.dust_{ns.dust}.shard{ishard}of{nshard}')
+    os.makedirs(shard_dir, exist_ok=True)
 
 # loop through tract files 
 # and select PFS cosmology targets
-targets = [] 
-for infile in infiles: 
+os.makedirs(os.path.join(shard_dir, 'runs'), exist_ok=True)
+files = [] 
+for infile in sorted(infiles, key=os.path.basename): 
     # read tract file 
-    tract = Table.read(infile)
+    tract = fits.getdata(infile)
 
     # preprocess tract file (using specified galactic extinction dust model) 
-    _hsc = Cuts._prepare_hsc(tract, dust_extinction=ns.dust)
+    _hsc = Cuts._prepare_hsc(tract, dust_extinction=ns.dust, cache=not ns.no_cache, 
+                             tract_file=infile)
 
     # apply PFS cosmology target selection 
     is_pfscosmo = Cuts.isCosmology(_hsc)
     
     # targets 
     targs = _hsc[is_pfscosmo]
-    targets.append(targs) 
 
-# combine all targets 
-targets = Table(np.concatenate(targets)) 
+    # targets of each tract are saved sorted by OBJID so that they can be 
+    # merged without holding every tract in memory 
+    frun = os.path.join('runs', '%i.npy' % len(files))
+    np.save(os.path.join(shard_dir, frun), targs[np.argsort(targs['OBJID'], kind='stable')])
+    files.append({'file': infile, 'size': os.path.getsize(infile), 
+                  'run': frun, 'ntarget': int(len(targs))}) 
+
+# healpix counts of all and unmasked randoms for the effective area map 
+randoms = None 
+if ranfiles is not None: 
+    nran = np.zeros(12 * ns.nside_map**2, dtype=np.int64) 
+    nran_all = np.zeros(12 * ns.nside_map**2, dtype=np.int64) 
+    for ranfile in sorted(ranfiles, key=os.path.basename): 
+        _ran = fits.getdata(ranfile) 
+        _mask = np.array(Cuts.random_masking(_ran)).astype(bool)
+        _hpix = U.hpx_pixel(_ran['ra'], _ran['dec']) 
+        nran_all += U.healpix_counts(_hpix, nside=ns.nside_map).astype(np.int64)
+        nran += U.healpix_counts(_hpix[~_mask], nside=ns.nside_map).astype(np.int64)
+    np.save(os.path.join(shard_dir, 'randoms.npy'), np.array([nran, nran_all]))
+    randoms = {'files': sorted(ranfiles, key=os.path.basename), 'counts': 'randoms.npy'}
+
+C.write_manifest(shard_dir, {'shard': ishard, 'nshard': nshard, 'dust': ns.dust, 
+                             'nside_map': ns.nside_map, 'files': files, 
+                             'randoms': randoms})
+if ns.shard is not None: 
+    sys.exit(0)
+
+# combine all targets removing objects that appear in more than one 
+# (overlapping) tract file 
+targets, ndropped, randoms = C.merge_shards([shard_dir], os.path.join(shard_dir, 'merged.npy')) 
+for name, n in ndropped.items(): 
+    if n > 0: print('%s: %i duplicate targets dropped' % (name, n))
 
 # write to file 
-targets.write(fout, overwrite=True) 
+C.write_targets(targets, fout, format=ns.format, nside=ns.nside) 
+C.write_healpix_maps(fmaps, targets, nside=ns.nside_map, randoms=randoms) 
+
+del targets
+tmpdir.cleanup()
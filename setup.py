@@ -5,8 +5,6 @@ import re
 
 from setuptools import find_packages, setup
 
-__version__ = '0.1'
-
 # PROJECT SPECIFIC
 
 NAME = "pfstarget"
@@ -44,6 +42,8 @@ def find_meta(meta, meta_file=read(META_PATH)):
     raise RuntimeError("Unable to find __{meta}__ string.".format(meta=meta))
 
 
+__version__ = find_meta("version")
+
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
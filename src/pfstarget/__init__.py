@@ -2,6 +2,7 @@
 
 #__all__ = [""]
 
+__version__ = "0.1"
 __author__ = "ChangHoon Hahn"
 __email__ = "changhoon.hahn@princeton.edu"
 __uri__ = "https://github.com/changhoonhahn/pfs-cosmo"
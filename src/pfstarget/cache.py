@@ -0,0 +1,230 @@
+'''
+
+module for the on-disk cache of extinction corrected magnitudes used by
+`cuts._prepare_hsc`
+
+
+environment variables:
+    PFSTARGET_CACHE_DIR : cache directory (default: ~/.cache/pfstarget).
+        Set to an empty string to disable the cache.
+
+    PFSTARGET_CACHE_SIZE : maximum size of the cache in bytes, e.g. 2e9
+        (default: 2GB). Least recently used entries are removed when it is
+        exceeded.
+
+The cache is skipped if it cannot be written.
+
+
+'''
+import os
+import hashlib
+import functools
+import numpy as np
+
+from . import __version__
+from . import extinction as E
+
+
+# columns of the hsc imaging used by `extinction._extinction_correct`
+HSC_COLUMNS = ['ra', 'dec', 'tract', 'patch',
+               'a_g', 'a_r', 'a_i', 'a_z', 'a_y',
+               'g_cmodel_mag', 'r_cmodel_mag', 'i_cmodel_mag', 'z_cmodel_mag', 'y_cmodel_mag']
+
+MAX_SIZE = 2 * 1024**3
+
+# version of the extinction correction. Bump it whenever the correction
+# changes (e.g. `extinction._extinction_correct` or how the zero-point offsets
+# are matched) so that cached magnitudes are not reused.
+CACHE_VERSION = 1
+
+# size of the cache directory in bytes as seen by this process. The directory
+# is scanned on the first save and then only when the estimate exceeds the
+# maximum size, so saving N entries does not stat the cache N times.
+_cache_size = {}
+
+
+def cache_dir():
+    ''' return cache directory or None if the cache is disabled
+    '''
+    path = os.environ.get('PFSTARGET_CACHE_DIR')
+    if path is None:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                            'pfstarget')
+    if path == '':
+        return None
+    return os.path.join(path, 'extinction')
+
+
+def cache_key(hsc, dust_extinction='sfd98', release='s23b', zeropoint=True,
+              tract_file=None):
+    ''' key of the extinction corrected magnitudes of hsc. The key combines
+    the dust model, the release, the zero-point flag, CACHE_VERSION, the
+    absorption coefficients, and the contents of the data files used by the
+    correction with the identity of the tract file (path, size, and
+    modification time) that hsc was read from. If no tract file is given, the
+    input columns (see HSC_COLUMNS) are hashed instead, which is much slower.
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((__version__, CACHE_VERSION, dust_extinction, release, bool(zeropoint),
+                   sorted(E.absorptionCoeff.items()), len(hsc))).encode())
+    for fdata in _data_files(dust_extinction, release, zeropoint):
+        h.update(_file_hash(fdata).encode())
+    if tract_file is not None:
+        stat = os.stat(tract_file)
+        h.update(repr((os.path.realpath(tract_file), stat.st_size, stat.st_mtime_ns)).encode())
+        return h.hexdigest()
+
+    for col in HSC_COLUMNS:
+        if col not in hsc.dtype.names:
+            h.update(f'{col}:missing'.encode())
+            continue
+        data = np.ma.asarray(hsc[col])
+        h.update(f'{col}:{data.dtype.str}'.encode())
+        h.update(np.ascontiguousarray(data.data).tobytes())
+        if np.ma.is_masked(data):
+            h.update(np.ascontiguousarray(np.ma.getmaskarray(data)).tobytes())
+    return h.hexdigest()
+
+
+def _data_files(dust_extinction, release, zeropoint):
+    ''' data files read by `extinction._extinction_correct`
+    '''
+    dat = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dat')
+    files = []
+    if zeropoint:
+        files.append(os.path.join(dat, f'{release}_stellar_offsets.csv.gz'))
+    if dust_extinction == 'desi':
+        files.append(os.path.join(dat, 'desi_dust_gr_512.fits'))
+    return files
+
+
+def _file_hash(fname):
+    ''' hash of the contents of a data file (computed once per process unless
+    the file changes)
+    '''
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return f'{os.path.basename(fname)}:missing'
+    return _file_hash_cached(fname, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_hash_cached(fname, size, mtime_ns):
+    h = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as f:
+        for block in iter(functools.partial(f.read, 2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load(key):
+    ''' return cached float32 array of key or None if it is not cached
+    '''
+    path = cache_dir()
+    if path is None:
+        return None
+    fcache = os.path.join(path, f'{key}.npy')
+    try:
+        data = np.load(fcache)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+    # mark entry as recently used
+    try:
+        os.utime(fcache)
+    except OSError:
+        pass
+    return data
+
+
+def save(key, data, max_size=None):
+    ''' save array to the cache under key and evict the least recently used
+    entries if the cache exceeds max_size bytes. Entries written by other
+    processes are only counted when the cache is next scanned.
+    '''
+    path = cache_dir()
+    if path is None:
+        return
+    if max_size is None:
+        max_size = max_cache_size()
+
+    fcache = os.path.join(path, f'{key}.npy')
+    # write to a temporary file first so concurrent jobs never read a partial
+    # entry
+    ftmp = os.path.join(path, f'.{key}.{os.getpid()}.npy')
+    try:
+        os.makedirs(path, exist_ok=True)
+        np.save(ftmp, np.asarray(data, dtype=np.float32))
+        os.replace(ftmp, fcache)
+    except OSError:
+        # the cache is optional: skip it if it cannot be written (e.g.
+        # read-only file system)
+        try:
+            os.remove(ftmp)
+        except OSError:
+            pass
+        return
+
+    if path not in _cache_size:
+        _cache_size[path] = sum(size for _, size, _ in _entries(path))
+    else:
+        _cache_size[path] += os.path.getsize(fcache)
+    if _cache_size[path] > max_size:
+        _cache_size[path] = evict(max_size)
+
+
+def max_cache_size():
+    ''' maximum size of the cache in bytes from PFSTARGET_CACHE_SIZE (e.g.
+    2000000000 or 2e9). Falls back to MAX_SIZE if it is not set or not a
+    number.
+    '''
+    try:
+        return int(float(os.environ['PFSTARGET_CACHE_SIZE']))
+    except (KeyError, ValueError, OverflowError):
+        return MAX_SIZE
+
+
+def evict(max_size):
+    ''' remove least recently used entries until the cache is at most
+    max_size bytes and return the size of the cache
+    '''
+    path = cache_dir()
+    if path is None:
+        return 0
+
+    entries = _entries(path)
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def _entries(path):
+    ''' (modification time, size, file name) of the entries of the cache
+    '''
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    entries = []
+    for name in names:
+        if name.startswith('.') or not name.endswith('.npy'):
+            continue
+        try:
+            stat = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    return entries
+
+
+def clear():
+    ''' remove all entries of the cache
+    '''
+    evict(0)
@@ -0,0 +1,591 @@
+'''
+
+module for reading, writing, and merging target catalogs
+
+
+'''
+import os
+import json
+import shutil
+import collections
+import numpy as np
+
+
+# name of the index file written at the top of a partitioned catalog
+INDEX_FILE = 'index.json'
+
+# name of the manifest file of a shard of `bin/select_targets.py`
+MANIFEST_FILE = 'manifest.json'
+
+# maximum number of column files kept open while writing a partitioned catalog
+MAX_OPEN_FILES = 256
+
+
+def target_filenames(dest, dust, format='fits', nside_map=128):
+    ''' return file names of the target catalog and the healpix maps written
+    by `bin/select_targets.py` and `bin/merge_shards.py` for output
+    directory or file name `dest`
+    '''
+    if format == 'npy':
+        # partitioned catalogs are directories
+        if os.path.isdir(dest):
+            fout = os.path.join(dest, f'pfs_target.dust_{dust}')
+        else:
+            raise ValueError('specify output directory')
+    elif os.path.isfile(dest):
+        fout = dest
+    elif os.path.isdir(dest):
+        fout = os.path.join(dest, f'pfs_target.dust_{dust}.fits')
+    else:
+        raise ValueError('specify output directory or filename')
+
+    # maps are named after the catalog stem (which for partitioned catalogs
+    # has no extension to strip)
+    if format == 'npy':
+        stem = fout
+    else:
+        stem = fout[:-len('.fits')] if fout.endswith('.fits') else fout
+    fmaps = f'{stem}.hpix{nside_map}.fits'
+    return fout, fmaps
+
+
+def write_targets(targets, fout, format='fits', nside=32, chunk_size=1000000):
+    ''' write target catalog as a single fits file (format='fits') or as a
+    healpix partitioned catalog of .npy files (format='npy'). targets is
+    written in chunks so it can be a memory mapped array larger than memory.
+    '''
+    if format == 'npy':
+        write_partitioned(targets, fout, nside=nside, overwrite=True,
+                          chunk_size=chunk_size)
+    elif format == 'fits':
+        _write_fits(targets, fout, chunk_size=chunk_size)
+    else:
+        raise ValueError(f"unknown format {format}")
+
+
+def _write_fits(targets, fout, chunk_size=1000000):
+    ''' write structured array to a fits binary table chunk by chunk with
+    `astropy.io.fits.StreamingHDU`. The file is the same as
+    `Table(targets).write(fout)`.
+    '''
+    from astropy.io import fits
+
+    header = fits.BinTableHDU(data=np.asarray(targets[:0])).header
+    header['NAXIS2'] = len(targets)
+    if _fits_rows(np.asarray(targets[:0])).dtype.itemsize != header['NAXIS1']:
+        raise ValueError("row size does not match the fits header")
+
+    # StreamingHDU appends to existing files
+    if os.path.exists(fout):
+        os.remove(fout)
+    hdu = fits.StreamingHDU(fout, header)
+    try:
+        for i0 in range(0, len(targets), chunk_size):
+            hdu.write(_fits_rows(np.asarray(targets[i0:i0+chunk_size])).view(np.uint8))
+    finally:
+        hdu.close()
+
+
+def _fits_rows(chunk):
+    ''' rows of a structured array in the layout of a fits binary table
+    (big-endian numbers and logical columns as T/F). Only the column types of
+    target catalogs (bool, signed integers, floats, and uint8) are supported.
+    '''
+    dtype = []
+    for col in chunk.dtype.names:
+        base, shape = chunk.dtype[col].base, chunk.dtype[col].shape
+        if base.kind == 'b':
+            dtype.append((col, 'S1', shape))
+        elif (base.kind == 'i' and base.itemsize > 1) or base.kind == 'f' or base == np.uint8:
+            dtype.append((col, base.newbyteorder('>'), shape))
+        else:
+            # e.g. unsigned integers are stored with an offset (TZERO)
+            raise TypeError(f"column {col} of type {base} is not supported")
+
+    rows = np.empty(len(chunk), dtype=dtype)
+    for col in chunk.dtype.names:
+        if chunk.dtype[col].base.kind == 'b':
+            rows[col] = np.where(chunk[col], b'T', b'F')
+        else:
+            rows[col] = chunk[col]
+    return rows
+
+
+def write_healpix_maps(fout, targets, nside=128, randoms=None, chunk_size=1000000):
+    ''' write healpix maps of the target counts and, if counts of randoms are
+    provided, the fraction of the area of each pixel that is not masked.
+
+    args:
+        fout : str
+            output fits file
+
+        targets : structured numpy array
+            target catalog with `HPXPIXEL` or `RA` and `DEC` columns
+
+    kwargs:
+        nside : int
+            healpix nside (RING ordering) of the maps. (Default: 128)
+
+        randoms : tuple
+            (nran, nran_all) healpix maps of the counts of unmasked randoms and
+            all randoms
+    '''
+    from astropy.table import Table
+    from . import util as U
+
+    maps = Table()
+    ntarget = np.zeros(12 * nside**2, dtype=np.int64)
+    for i0 in range(0, len(targets), chunk_size):
+        chunk = targets[i0:i0+chunk_size]
+        if 'HPXPIXEL' in targets.dtype.names:
+            ntarget += U.healpix_counts(chunk['HPXPIXEL'], nside=nside).astype(np.int64)
+        else:
+            ntarget += U.healpixelize(chunk['RA'], chunk['DEC'], nside=nside).astype(np.int64)
+    maps['N_TARGET'] = ntarget
+    if randoms is not None:
+        nran, nran_all = randoms
+        maps['N_RANDOM'] = nran
+        maps['N_RANDOM_ALL'] = nran_all
+        frac = np.zeros(len(nran))
+        np.divide(nran, nran_all, out=frac, where=(nran_all > 0))
+        maps['FRAC_AREA'] = frac
+    maps.write(fout, overwrite=True)
+    return maps
+
+
+def write_manifest(path, manifest):
+    ''' write manifest of a shard
+    '''
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def read_manifest(path):
+    ''' read manifest of a shard
+    '''
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+def merge_shards(paths, fout, key='OBJID', chunk_size=1000000):
+    ''' merge the outputs of the shards of `bin/select_targets.py --shard`.
+
+    The per-tract runs of every shard are merged in the order of the tract
+    file names and duplicates are dropped with `merge_unique`, so the result
+    does not depend on the number of shards.
+
+    args:
+        paths : list
+            shard directories (each with a manifest.json). All shards
+            0..nshard-1 must be included.
+
+        fout : str
+            temporary .npy file the merged catalog is written to. Memory use
+            does not depend on the size of the catalog.
+
+    return:
+        targets : memory mapped structured numpy array
+            merged target catalog sorted by `key`
+
+        ndropped : dict
+            number of duplicate targets dropped from each tract file
+
+        randoms : tuple or None
+            (nran, nran_all) healpix counts of unmasked and all randoms summed
+            over the shards or None if randoms were not processed
+    '''
+    manifests = [read_manifest(path) for path in paths]
+    if len(manifests) == 0:
+        raise ValueError("no shards to merge")
+
+    nshard = manifests[0]['nshard']
+    ishards = sorted(m['shard'] for m in manifests)
+    if ishards != list(range(nshard)):
+        raise ValueError(f"expected shards 0..{nshard-1}, got {ishards}")
+    for k in ['nshard', 'dust', 'nside_map']:
+        if len(set(m[k] for m in manifests)) > 1:
+            raise ValueError(f"shards have inconsistent {k}")
+    if len(set(m['randoms'] is None for m in manifests)) > 1:
+        raise ValueError("randoms were not processed for all shards")
+
+    # per-tract runs of all shards in the order of the tract file names
+    entries = [(os.path.basename(entry['file']), os.path.join(path, entry['run']))
+               for path, m in zip(paths, manifests) for entry in m['files']]
+    entries.sort()
+    names = [name for name, _ in entries]
+    if len(names) == 0:
+        raise ValueError("no tract files in shards")
+    if len(set(names)) != len(names):
+        raise ValueError("tract file included in more than one shard")
+
+    runs = [np.load(frun, mmap_mode='r') for _, frun in entries]
+
+    # merged chunks are streamed into a memory mapped .npy file that can hold
+    # all rows; the returned array is the filled part of it
+    merged = np.lib.format.open_memmap(fout, mode='w+', dtype=runs[0].dtype,
+                                       shape=(sum(len(run) for run in runs),))
+    nrows = 0
+    _ndropped = np.zeros(len(runs), dtype=int)
+    for chunk, n in merge_unique(runs, key=key, chunk_size=chunk_size):
+        merged[nrows:nrows+len(chunk)] = chunk
+        nrows += len(chunk)
+        _ndropped += n
+    merged.flush()
+    targets = merged[:nrows]
+    ndropped = dict(zip(names, _ndropped.tolist()))
+
+    randoms = None
+    if manifests[0]['randoms'] is not None:
+        randoms = [np.load(os.path.join(path, m['randoms']['counts'])) for path, m in
+                   zip(paths, manifests)]
+        randoms = tuple(np.sum(randoms, axis=0))
+    return targets, ndropped, randoms
+
+
+def write_partitioned(objects, dest, nside=32, overwrite=False, chunk_size=1000000):
+    ''' write catalog of objects to a directory partitioned by NESTED healpix
+    pixel. Each column of each partition is written to its own `.npy` file so
+    that readers can memory map only the columns and pixels they need.
+
+    directory layout:
+
+        dest/index.json
+        dest/hpx{nside}-{pixel}/{COLUMN}.npy
+
+    args:
+        objects : structured numpy array (e.g. output of `cuts._prepare_hsc`)
+            with `HPXPIXEL` or `RA` and `DEC` columns
+
+        dest : str
+            output directory
+
+    kwargs:
+        nside : int
+            healpix nside of the partitions. (Default: 32, ~3.4 sq.deg)
+
+        overwrite : bool
+            if True, remove existing partitioned catalog at dest. Paths
+            without an index.json are never removed.
+
+        chunk_size : int
+            number of objects read at a time.
+
+    return:
+        index : dict
+            contents of the index file
+    '''
+    from . import util as U
+
+    objects = np.asarray(objects)
+    if objects.dtype.names is None:
+        raise ValueError("objects must be a structured array")
+
+    if os.path.exists(dest):
+        if not overwrite:
+            raise ValueError(f"{dest} already exists; use overwrite=True")
+        # only ever remove a previous partitioned catalog
+        if not os.path.isfile(os.path.join(dest, INDEX_FILE)):
+            raise ValueError(f"{dest} exists and is not a partitioned catalog")
+        shutil.rmtree(dest)
+    os.makedirs(dest)
+
+    def _pixels(chunk):
+        if 'HPXPIXEL' in chunk.dtype.names:
+            return U.degrade_pixel(chunk['HPXPIXEL'], nside)
+        return U.degrade_pixel(U.hpx_pixel(chunk['RA'], chunk['DEC']), nside)
+
+    # objects are read in chunks (twice) so that memory mapped catalogs are
+    # never loaded in full. First count the rows of each partition...
+    counts = {}
+    for i0 in range(0, len(objects), chunk_size):
+        upix, n = np.unique(_pixels(objects[i0:i0+chunk_size]), return_counts=True)
+        for pix, _n in zip(upix.tolist(), n.tolist()):
+            counts[pix] = counts.get(pix, 0) + _n
+
+    # every column file of every partition starts with its .npy header...
+    for pix, n in counts.items():
+        pdir = _partition_dir(dest, nside, pix)
+        os.makedirs(pdir)
+        for col in objects.dtype.names:
+            header = np.lib.format.header_data_from_array_1_0(
+                    np.zeros(0, dtype=objects.dtype[col]))
+            header['shape'] = (n,) + header['shape'][1:]
+            with open(os.path.join(pdir, f'{col}.npy'), 'wb') as f:
+                np.lib.format.write_array_header_1_0(f, header)
+
+    # ... then the rows of each partition are appended in the order of the
+    # objects. Files stay open across chunks (the least recently used ones
+    # are closed once MAX_OPEN_FILES are open).
+    handles = collections.OrderedDict()
+
+    def _handle(fname):
+        if fname in handles:
+            handles.move_to_end(fname)
+        else:
+            if len(handles) >= MAX_OPEN_FILES:
+                handles.popitem(last=False)[1].close()
+            handles[fname] = open(fname, 'ab')
+        return handles[fname]
+
+    try:
+        for i0 in range(0, len(objects), chunk_size):
+            chunk = np.asarray(objects[i0:i0+chunk_size])
+            hpix = _pixels(chunk)
+            isort = np.argsort(hpix, kind='stable')
+            hpix = hpix[isort]
+            columns = {col: np.ascontiguousarray(chunk[col][isort]) for col in objects.dtype.names}
+            upix, istart, nrows = np.unique(hpix, return_index=True, return_counts=True)
+            for pix, j0, n in zip(upix.tolist(), istart, nrows):
+                pdir = _partition_dir(dest, nside, pix)
+                for col in objects.dtype.names:
+                    _handle(os.path.join(pdir, f'{col}.npy')).write(columns[col][j0:j0+n])
+    finally:
+        for f in handles.values():
+            f.close()
+
+    partitions = {str(pix): int(counts[pix]) for pix in sorted(counts)}
+
+    index = {
+            'nside': int(nside),
+            'nest': True,
+            'nrows': int(len(objects)),
+            'columns': [[col, objects.dtype[col].str] for col in objects.dtype.names],
+            'partitions': partitions
+            }
+    # index is written last so that an incomplete catalog has no index
+    with open(os.path.join(dest, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def read_index(path):
+    ''' read index of a partitioned catalog
+    '''
+    with open(os.path.join(path, INDEX_FILE), 'r') as f:
+        index = json.load(f)
+    index['partitions'] = {int(pix): n for pix, n in index['partitions'].items()}
+    return index
+
+
+def iter_partitions(path, columns=None, pixels=None):
+    ''' iterate over the partitions of a partitioned catalog. Columns are
+    memory mapped read-only so nothing is read from disk until it is used.
+
+    args:
+        path : str
+            directory of the partitioned catalog
+
+    kwargs:
+        columns : list
+            columns to load. If None, all columns are loaded.
+
+        pixels : array_like
+            NESTED healpix pixels (at the nside of the catalog) to load. If
+            None, all partitions are loaded.
+
+    return:
+        generator of (pixel, dict of column name to memory mapped array)
+    '''
+    index = read_index(path)
+    columns = _check_columns(index, columns)
+
+    for pix in _select_pixels(index, pixels):
+        pdir = _partition_dir(path, index['nside'], pix)
+        yield pix, {col: np.load(os.path.join(pdir, f'{col}.npy'), mmap_mode='r')
+                    for col in columns}
+
+
+def read_partitioned(path, columns=None, pixels=None):
+    ''' read a partitioned catalog into a single structured numpy array
+
+    args:
+        path : str
+            directory of the partitioned catalog
+
+    kwargs:
+        columns : list
+            columns to load. If None, all columns are loaded.
+
+        pixels : array_like
+            NESTED healpix pixels (at the nside of the catalog) to load. If
+            None, all partitions are loaded.
+
+    return:
+        objects: structured numpy array
+    '''
+    index = read_index(path)
+    columns = _check_columns(index, columns)
+    dtypes = dict(index['columns'])
+
+    pixels = _select_pixels(index, pixels)
+    nrows = sum(index['partitions'][pix] for pix in pixels)
+
+    objects = np.zeros(nrows, dtype=[(col, dtypes[col]) for col in columns])
+    i0 = 0
+    for _, part in iter_partitions(path, columns=columns, pixels=pixels):
+        n = len(part[columns[0]]) if len(columns) > 0 else 0
+        for col in columns:
+            objects[col][i0:i0+n] = part[col]
+        i0 += n
+    return objects
+
+
+def query_disc(path, ra, dec, radius, columns=None):
+    ''' read objects of a partitioned catalog within a circular region
+
+    args:
+        path : str
+            directory of the partitioned catalog
+
+        ra, dec : float
+            center of the region in degrees
+
+        radius : float
+            radius of the region in degrees
+
+    kwargs:
+        columns : list
+            columns to return. If None, all columns are returned.
+
+    return:
+        objects: structured numpy array of objects within the region
+    '''
+    import healpy as hp
+    from numpy.lib import recfunctions as rfn
+    index = read_index(path)
+
+    vec = hp.ang2vec(ra, dec, lonlat=True)
+    pixels = hp.query_disc(index['nside'], vec, np.radians(radius),
+                           inclusive=True, nest=True)
+
+    # RA and DEC are always needed for the exact cut
+    _columns = _check_columns(index, columns)
+    _load = _columns + [col for col in ['RA', 'DEC'] if col not in _columns]
+    objects = read_partitioned(path, columns=_load, pixels=pixels)
+
+    in_disc = (_angular_separation(ra, dec, objects['RA'], objects['DEC']) <= radius)
+    # selecting fields gives a view with the itemsize of all loaded columns
+    return rfn.repack_fields(objects[in_disc][_columns])
+
+
+def merge_unique(runs, key='OBJID', chunk_size=1000000):
+    ''' k-way merge of catalogs (runs) that are each sorted by `key` that
+    drops objects with duplicate `key`. When an object appears more than once,
+    the row from the earliest run is kept. Runs are consumed in chunks of
+    chunk_size // len(runs) rows so memory is bounded by ~chunk_size rows
+    regardless of the total size and the number of the catalogs. Runs can be
+    memory mapped arrays (e.g. `np.load(..., mmap_mode='r')`).
+
+    args:
+        runs : list of structured numpy arrays
+            catalogs with the same dtype, each sorted by `key`
+
+    kwargs:
+        key : str
+            column used to identify duplicates. (Default: OBJID)
+
+        chunk_size : int
+            number of rows buffered over all runs. Each yielded chunk has at
+            most max(chunk_size, len(runs)) rows, unless a key is repeated
+            across the ends of the buffers.
+
+    return:
+        generator of (objects, ndropped) where objects is a chunk of the
+        merged catalog in `key` order and ndropped is an array with the number
+        of duplicates dropped from each run in that chunk.
+    '''
+    runs = [run for run in runs]
+    if len(runs) == 0:
+        return
+    dtype = runs[0].dtype
+    for run in runs:
+        if run.dtype != dtype:
+            raise ValueError("runs must have the same dtype")
+
+    nruns = len(runs)
+    nread = max(1, chunk_size // nruns)    # rows read from a run at a time
+    pos = np.zeros(nruns, dtype=int)       # next row to read from each run
+    bufs = [np.asarray(runs[i][:0]) for i in range(nruns)]
+    tails = [runs[i][key][:0] for i in range(nruns)]   # last key read
+
+    def _read(i, n):
+        _buf = np.asarray(runs[i][pos[i]:pos[i]+n])
+        _keys = np.concatenate([tails[i], _buf[key]])
+        if np.any(_keys[1:] < _keys[:-1]):
+            raise ValueError(f"run {i} is not sorted by {key}")
+        pos[i] += len(_buf)
+        tails[i] = _keys[-1:]
+        return np.concatenate([bufs[i], _buf])
+
+    while True:
+        # top up buffers that are less than half full so that every chunk
+        # advances through all runs by ~nread rows
+        for i in range(nruns):
+            if len(bufs[i]) <= nread // 2 and pos[i] < len(runs[i]):
+                bufs[i] = _read(i, nread - len(bufs[i]))
+
+        active = [i for i in range(nruns) if len(bufs[i]) > 0]
+        if len(active) == 0:
+            break
+
+        # all rows with key < bound have been read from every run, so
+        # duplicates never straddle two chunks
+        pending = [i for i in active if pos[i] < len(runs[i])]
+        if len(pending) > 0:
+            bound = min(bufs[i][key][-1] for i in pending)
+            nsafe = [np.searchsorted(bufs[i][key], bound, side='left') for i in active]
+        else:
+            nsafe = [len(bufs[i]) for i in active]
+
+        if sum(nsafe) == 0:
+            # buffers end on a run of identical keys; read further ahead
+            for i in pending:
+                if bufs[i][key][-1] == bound:
+                    bufs[i] = _read(i, nread)
+            continue
+
+        chunk = np.concatenate([bufs[i][:n] for i, n in zip(active, nsafe)])
+        irun = np.concatenate([np.full(n, i) for i, n in zip(active, nsafe)])
+        for i, n in zip(active, nsafe):
+            bufs[i] = bufs[i][n:]
+
+        # sort by key then run so the first row of each key is from the
+        # earliest run
+        isort = np.lexsort((irun, chunk[key]))
+        chunk, irun = chunk[isort], irun[isort]
+
+        keep = np.ones(len(chunk), dtype=bool)
+        keep[1:] = (chunk[key][1:] != chunk[key][:-1])
+
+        ndropped = np.bincount(irun[~keep], minlength=nruns)
+        yield chunk[keep], ndropped
+
+
+def _angular_separation(ra0, dec0, ra, dec):
+    ''' angular separation in degrees (haversine formula)
+    '''
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    ra, dec = np.radians(np.asarray(ra, dtype=float)), np.radians(np.asarray(dec, dtype=float))
+    hav = (np.sin(0.5 * (dec - dec0))**2 +
+           np.cos(dec) * np.cos(dec0) * np.sin(0.5 * (ra - ra0))**2)
+    return np.degrees(2. * np.arcsin(np.sqrt(np.clip(hav, 0., 1.))))
+
+
+def _partition_dir(path, nside, pix):
+    return os.path.join(path, f'hpx{nside}-{int(pix)}')
+
+
+def _check_columns(index, columns):
+    names = [col for col, _ in index['columns']]
+    if columns is None:
+        return names
+    missing = [col for col in columns if col not in names]
+    if len(missing) > 0:
+        raise ValueError(f"columns {missing} not in catalog")
+    return list(columns)
+
+
+def _select_pixels(index, pixels):
+    if pixels is None:
+        return sorted(index['partitions'].keys())
+    return [int(pix) for pix in np.unique(pixels) if int(pix) in index['partitions']]
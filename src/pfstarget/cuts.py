@@ -6,7 +6,9 @@ module for target selection
 '''
 import numpy as np 
 
+from . import cache as C
 from . import extinction as E
+from . import util as U
 
 
 def isCosmology(objects, star_galaxy_cut=-0.15, magnitude_cut=22.5,
@@ -120,7 +122,8 @@ def masking(objects):
     return _mask 
 
 
-def _prepare_hsc(hsc, dust_extinction='sfd98', release='s23b', zeropoint=True): 
+def _prepare_hsc(hsc, dust_extinction='sfd98', release='s23b', zeropoint=True,
+                 cache=None, tract_file=None): 
     ''' prepare hsc imaging data for target selection 
 
     args:
@@ -133,14 +136,26 @@ def _prepare_hsc(hsc, dust_extinction='sfd98', release='s23b', zeropoint=True):
 
         release : str
             string specifying the hsc data release (default: s23b) 
+
+        cache : bool
+            if True, extinction corrected magnitudes are read from and saved
+            to the on-disk cache (see pfstarget.cache). If None, the cache is
+            only used when tract_file is given. (default: None) 
+
+        tract_file : str
+            file hsc was read from. It identifies hsc in the cache; without
+            it the input columns are hashed, which takes about as long as the
+            correction itself. (default: None)
     
     return: 
         objects: structured numpy array of hsc objects with relevant columns
-        for target selection 
+        for target selection. HPXPIXEL is the high resolution NESTED healpix
+        pixel (nside=util.HPX_NSIDE) from which coarser pixels are derived. 
     '''
     dtype = [('OBJID', '<i8'), 
              ('RA', 'f4'), 
              ('DEC', 'f4'), 
+             ('HPXPIXEL', '<i8'), 
              ('G_MAG', 'f4'), 
              ('R_MAG', 'f4'), 
              ('I_MAG', 'f4'), 
@@ -174,15 +189,28 @@ def _prepare_hsc(hsc, dust_extinction='sfd98', release='s23b', zeropoint=True):
 
     objects = np.zeros(len(hsc), dtype=dtype)
 
+    # healpix pixel computed once from the full precision ra and dec 
+    objects['HPXPIXEL'] = U.hpx_pixel(hsc['ra'], hsc['dec']) 
+
     # grizy magnitudes corrections for galactic dust extinction 
-    _g, _r, _i, _z, _y = E._extinction_correct(hsc, method=dust_extinction, 
+    key, grizy = None, None 
+    if cache is None: cache = (tract_file is not None) 
+    if cache: 
+        key = C.cache_key(hsc, dust_extinction=dust_extinction, release=release, 
+                          zeropoint=zeropoint, tract_file=tract_file)
+        grizy = C.load(key) 
+    if grizy is None or grizy.shape != (5, len(hsc)): 
+        grizy = np.array(E._extinction_correct(hsc, method=dust_extinction, 
                                                release=release,
-                                               zeropoint=zeropoint)
-    objects['G_MAG'] = _g
-    objects['R_MAG'] = _r
-    objects['I_MAG'] = _i
-    objects['Z_MAG'] = _z
-    objects['Y_MAG'] = _y
+                                               zeropoint=zeropoint, 
+                                               hpxpixel=objects['HPXPIXEL']), 
+                         dtype=np.float32)
+        if cache: C.save(key, grizy) 
+    objects['G_MAG'] = grizy[0]
+    objects['R_MAG'] = grizy[1]
+    objects['I_MAG'] = grizy[2]
+    objects['Z_MAG'] = grizy[3]
+    objects['Y_MAG'] = grizy[4]
 
     # uncorrected grizy magnitudes
     objects['G_MAG_0'] = hsc["g_cmodel_mag"]
@@ -5,8 +5,17 @@ module for correcting for galactic extinction
 
 '''
 import os
+import gzip
+import functools
 import numpy as np 
-from astropy.table import Table, join
+
+from . import util as U
+
+# astropy is only imported when it is needed, and healpy is not imported at
+# all, since importing them dominates the start up time of short jobs. 
+
+# healpy.UNSEEN: value of pixels without data 
+UNSEEN = -1.6375e+30
 
 # absorption coefficients of HSC filters
 absorptionCoeff = {
@@ -29,10 +38,14 @@ absorptionCoeff = {
 }
 
 
-def _extinction_correct(hsc, method='sfd98', release='s23b', zeropoint=True): 
+def _extinction_correct(hsc, method='sfd98', release='s23b', zeropoint=True,
+                        hpxpixel=None): 
     ''' apply correction for galactic extinction using different methods (SFD98,
     Zhou DESI) and zero-point photometry correction  
 
+    hpxpixel are the high resolution NESTED healpix pixels of the objects (see
+    `util.hpx_pixel`). They are computed from ra and dec if not provided. 
+
 
     comments: 
     * CHH (03/06/2025): We may want to separate the zero-point photometry correction from
@@ -70,22 +83,11 @@ def _extinction_correct(hsc, method='sfd98', release='s23b', zeropoint=True):
             y_mag -= grizy_offset[4]
         
     elif method == 'desi': 
-        import healpy as hp
-        
         nside = 512 # healpix nside hardcoded
-        _hsc = Table() 
-        _hsc['HPXPIXEL'] = hp.ang2pix(nside, np.radians(90.0 - hsc['dec']), np.radians(hsc['ra']))
-
-        # read dust model 
-        desi_dust = Table.read(os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                            'dat', 'desi_dust_gr_512.fits'))
+        if hpxpixel is None: hpxpixel = U.hpx_pixel(hsc['ra'], hsc['dec'])
 
         # get E(B-V) value based on healpixel  
-        null = np.full(hp.nside2npix(nside), hp.UNSEEN)  
-        desi_full = Table()
-        desi_full['EBV_DESI'] = null.copy()
-        desi_full['EBV_DESI'][desi_dust['HPXPIXEL']] = desi_dust['EBV_GR']
-        ebv_desi = desi_full['EBV_DESI'][_hsc['HPXPIXEL']]
+        ebv_desi = _desi_ebv_map()[U.degrade_pixel(hpxpixel, nside)]
 
         a_g = absorptionCoeff['g'] * ebv_desi
         a_r = absorptionCoeff['r'] * ebv_desi
@@ -131,23 +133,85 @@ def _extinction_correct(hsc, method='sfd98', release='s23b', zeropoint=True):
 
 def _get_zeropoint_correct(tract, patch, release='s23b'): 
     ''' return g/r/i/z/y-band photometric zeropoint correction based on tract
-    and patch. 
+    and patch. Tracts and patches without an offset are not corrected. 
     '''
     if release != 's23b': 
         raise ValueError("zero-point correction only for S23B")
      
-    # read pdr3_wide.stellar_sequence_offsets
+    tract, patch = np.asarray(tract), np.asarray(patch) 
+
+    # match offsets to the input tracts and patches (in the input order) 
+    output = np.zeros((5, len(tract))) 
+    for _tract in np.unique(tract): 
+        is_tract = (tract == _tract) 
+        patches, offsets = _zeropoint_offsets(int(_tract), release=release) 
+        if len(patches) == 0: continue 
+
+        i_match = np.clip(np.searchsorted(patches, patch[is_tract]), 0, len(patches)-1)
+        has_offset = (patches[i_match] == patch[is_tract])
+        output[:,is_tract] = np.where(has_offset, offsets[:,i_match], 0.) 
+    return output
+
+
+@functools.lru_cache(maxsize=None)
+def _zeropoint_offsets(tract, release='s23b'): 
+    ''' return sorted patches and the corresponding g/r/i/z/y-band offsets
+    of a tract. Missing offsets are set to 0. 
+    '''
+    names, lines = _zeropoint_lines(release) 
+    lines = lines.get(tract, []) 
+    if len(lines) == 0: 
+        return np.zeros(0, dtype=int), np.zeros((5, 0))
+
+    cols = [names.index(col) for col in ['patch', 'g_mag_offset', 'r_mag_offset', 
+                                         'i_mag_offset', 'z_mag_offset', 'y_mag_offset']]
+    # empty offsets are read as 0 (a dict of converters works on all numpy
+    # versions; a single callable requires numpy>=1.23) 
+    data = np.loadtxt(lines, delimiter=',', usecols=cols, ndmin=2, 
+                      converters={col: _float_or_zero for col in cols}) 
+
+    isort = np.argsort(data[:,0], kind='stable') 
+    return data[isort,0].astype(int), data[isort,1:].T
+
+
+def _float_or_zero(s): 
+    ''' converter for np.loadtxt that reads empty values as 0 
+    '''
+    if isinstance(s, bytes): s = s.decode() 
+    return float(s) if s.strip() else 0.
+
+
+@functools.lru_cache(maxsize=None)
+def _zeropoint_lines(release='s23b'): 
+    ''' read pdr3_wide.stellar_sequence_offsets once and group its lines by
+    tract. Lines are only parsed for the tracts that are used.
+    '''
     foffset = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                'dat', 's23b_stellar_offsets.csv.gz')
-    offsets = Table.read(foffset, format='csv') 
-        
-    # match offsets to the input tracts and patches
-    _tp = Table([tract, patch], names=['tract', 'patch'])
-    mtable = join(_tp, offsets, join_type='left')
-
-    output = np.array([np.array(mtable['g_mag_offset']), 
-                       np.array(mtable['r_mag_offset']), 
-                       np.array(mtable['i_mag_offset']), 
-                       np.array(mtable['z_mag_offset']), 
-                       np.array(mtable['y_mag_offset'])]) 
-    return output 
+                'dat', f'{release}_stellar_offsets.csv.gz')
+    with gzip.open(foffset, 'rt') as f: 
+        names = f.readline().strip().split(',') 
+        lines = f.read().splitlines() 
+
+    itract = names.index('tract')
+    tracts = {} 
+    for line in lines: 
+        tracts.setdefault(int(line.split(',', itract+1)[itract]), []).append(line)
+    return names, tracts
+
+
+@functools.lru_cache(maxsize=None)
+def _desi_ebv_map(): 
+    ''' read DESI E(B-V) dust map once and return it as a full sky healpix map
+    (nside=512, NESTED) 
+    '''
+    from astropy.io import fits
+    desi_dust = fits.getdata(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                          'dat', 'desi_dust_gr_512.fits'))
+
+    nside = 512 
+    ebv = np.full(12 * nside**2, UNSEEN)  
+    ebv[np.array(desi_dust['HPXPIXEL'])] = np.array(desi_dust['EBV_GR'])
+    # NESTED so that it can be indexed with degraded object pixels 
+    ebv = ebv[U.nest2ring(nside, np.arange(12 * nside**2))] 
+    ebv.flags.writeable = False
+    return ebv 
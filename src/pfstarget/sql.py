@@ -0,0 +1,254 @@
+'''
+
+module for pushing the target selection into the HSC catalog SQL queries
+(see bin/hsc/sql) so that objects that can never be selected are not
+downloaded.
+
+
+'''
+import inspect
+import numpy as np
+
+from . import cuts as Cuts
+from . import extinction as E
+
+
+# placeholder in the SQL templates replaced by the pre-filter
+PLACEHOLDER = '-- {$prefilter}'
+
+# tables of the s23b_wide database joined in s23b_wide_pfs.sql
+SQL_TABLES = {
+        'f1': 's23b_wide.forced',
+        'f2': 's23b_wide.forced2',
+        'm1': 's23b_wide.meas',
+        'm2': 's23b_wide.meas2',
+        'm3': 's23b_wide.meas3',
+        'msk': 's23b_wide.masks',
+        }
+
+# zero-point offsets with |offset| at least this large (-198 in g, 59.4 in i,
+# and -148.5 in y) are sentinels of patches without a valid offset
+SENTINEL_OFFSET = 1.
+
+# columns of the tract files used by the target selection and the
+# corresponding columns of the s23b_wide database in s23b_wide_pfs.sql
+SQL_COLUMNS = {
+        'a_g': 'f1.a_g',
+        'a_i': 'f1.a_i',
+        'g_cmodel_mag': 'f1.g_cmodel_mag',
+        'r_cmodel_mag': 'f1.r_cmodel_mag',
+        'i_cmodel_mag': 'f1.i_cmodel_mag',
+        'z_cmodel_mag': 'f1.z_cmodel_mag',
+        'g_cmodel_mag_err': 'f1.g_cmodel_magerr',
+        'g_psf_flag': 'f2.g_psfflux_flag',
+        'r_psf_flag': 'f2.r_psfflux_flag',
+        'i_psf_flag': 'f2.i_psfflux_flag',
+        'z_psf_flag': 'f2.z_psfflux_flag',
+        'i_meas_cmodel_mag': 'm1.i_cmodel_mag',
+        'i_meas_cmodel_flag': 'm1.i_cmodel_flag',
+        'deblend_skipped': 'm1.deblend_skipped',
+        'i_meas_psf_mag': 'm2.i_psfflux_mag',
+        'i_meas_psf_flag': 'm2.i_psfflux_flag',
+        'i_apertureflux_10_mag': 'm3.i_apertureflux_10_mag',
+        'i_apertureflux_10_flag': 'm3.i_apertureflux_10_flag',
+        'i_mask_brightstar_halo': 'msk.i_mask_brightstar_halo',
+        'i_mask_brightstar_ghost': 'msk.i_mask_brightstar_ghost',
+        'i_mask_brightstar_blooming': 'msk.i_mask_brightstar_blooming',
+        }
+
+
+def prefilter(dmag=0.5, eps=1e-3, release='s23b', **kwargs):
+    ''' conservative server-side pre-filter derived from the parameters of
+    `cuts.isCosmology`. Every object selected by `cuts.isCosmology` passes the
+    pre-filter.
+
+    Cuts on extinction corrected magnitudes are applied to the cmodel
+    magnitudes corrected with the SFD98 extinction (a_*) in the database and
+    loosened by `dmag`. This assumes that `dmag` is larger than the valid
+    zero-point offsets of the g, r, i, and z bands plus the difference between
+    the SFD98 and DESI extinction. The first part is checked. Patches without
+    a valid offset have sentinel offsets (see SENTINEL_OFFSET) that shift g or
+    i by tens of magnitudes, so `cuts.isCosmology` never selects their objects
+    (g - r or i are far outside the color cut) and the pre-filter does not need
+    to cover them. The second part is not checked; use `verify_prefilter` on
+    tracts processed with the DESI dust map.
+
+    kwargs:
+        dmag : float
+            margin on cuts on extinction corrected magnitudes. (Default: 0.5)
+
+        eps : float
+            margin on all other cuts to account for the float32 columns used
+            in the target selection. (Default: 1e-3)
+
+        release : str
+            hsc data release of the zero-point offsets. (Default: s23b)
+
+        **kwargs : parameters of `cuts.isCosmology`
+
+    return:
+        list of SQL conditions
+    '''
+    params = _cosmology_params(**kwargs)
+    c = SQL_COLUMNS
+
+    max_offset = _max_zeropoint_offset(release=release)
+    if dmag <= max_offset:
+        raise ValueError(f"dmag={dmag} is not larger than the zero-point offsets "
+                         f"(up to {max_offset:.3f} mag)")
+
+    conds = []
+    # masking: not within the bright star masks
+    for mask in ['halo', 'ghost', 'blooming']:
+        conds.append(f"{c['i_mask_brightstar_' + mask]} IS NOT TRUE")
+
+    # quality cuts (see cuts.quality_cuts)
+    for b in 'griz':
+        conds.append(f"{c[b + '_cmodel_mag']} IS NOT NULL")
+    for b in 'griz':
+        conds.append(f"{c[b + '_psf_flag']} IS NOT TRUE")
+    conds.append(f"{c['g_cmodel_mag_err']} < "
+                 f"0.05 * ({c['g_cmodel_mag']} - {c['a_g']} + {_f(dmag)}) - {_f(1.1 - eps)}")
+    conds.append(f"{c['deblend_skipped']} IS NOT TRUE")
+    conds.append(f"{c['i_apertureflux_10_mag']} <= {_f(25.5 + eps)}")
+    conds.append(f"{c['i_apertureflux_10_flag']} IS NOT TRUE")
+
+    # star-galaxy separation (see cuts.star_galaxy)
+    conds.append(f"{c['i_meas_cmodel_mag']} - {c['i_meas_psf_mag']} < "
+                 f"{_f(params['star_galaxy_cut'] + eps)}")
+    conds.append(f"{c['i_meas_cmodel_flag']} IS NOT TRUE")
+    conds.append(f"{c['i_meas_psf_flag']} IS NOT TRUE")
+
+    # magnitude window of the color cut (see cuts.color_cut)
+    conds.append(f"{c['i_cmodel_mag']} - {c['a_i']} > {_f(params['magnitude_cut'] - dmag - eps)}")
+    conds.append(f"{c['i_cmodel_mag']} - {c['a_i']} < {_f(24. + dmag + eps)}")
+    return conds
+
+
+def inject_prefilter(sql, **kwargs):
+    ''' replace the pre-filter placeholder (`-- {$prefilter}`) in the WHERE
+    clause of an SQL template with the conditions of `prefilter`.
+
+    args:
+        sql : str
+            SQL template (e.g. contents of s23b_wide_pfs.sql)
+
+    kwargs:
+        **kwargs : passed to `prefilter`
+
+    return:
+        sql : str
+    '''
+    if PLACEHOLDER not in sql:
+        raise ValueError(f"no {PLACEHOLDER} placeholder in the SQL template")
+
+    block = [f'AND {cond}' for cond in prefilter(**kwargs)]
+
+    # keep the indentation of the placeholder
+    i_line = sql[:sql.index(PLACEHOLDER)].rfind('\n') + 1
+    indent = sql[i_line:sql.index(PLACEHOLDER)]
+    return sql.replace(PLACEHOLDER, ('\n' + indent).join(block), 1)
+
+
+def verify_prefilter(hsc, dust_extinction='sfd98', release='s23b',
+                     zeropoint=True, dmag=0.5, eps=1e-3, **kwargs):
+    ''' run the pre-filter on a local SQLite stand-in of the s23b_wide tables
+    built from a tract and check that every target selected from all objects
+    passes the pre-filter. The extinction corrected magnitudes are not cached.
+
+    args:
+        hsc : astropy.table
+            tract downloaded with s23b_wide_pfs.sql
+
+    kwargs:
+        dust_extinction, release, zeropoint : passed to `cuts._prepare_hsc`
+            (release is also passed to `prefilter`)
+
+        dmag, eps : passed to `prefilter`
+
+        **kwargs : parameters of `cuts.isCosmology`
+
+    return:
+        in_prefilter : boolean array of the objects that pass the pre-filter
+
+        nlost : int
+            number of targets that do not pass the pre-filter (should be 0)
+    '''
+    import sqlite3
+
+    in_prefilter = np.zeros(len(hsc), dtype=bool)
+    if len(hsc) > 0:
+        conds = prefilter(dmag=dmag, eps=eps, release=release, **kwargs)
+
+        db = sqlite3.connect(':memory:')
+        db.execute("ATTACH DATABASE ':memory:' AS s23b_wide")
+        # object_id of the stand-in is the row number so duplicates in the
+        # tract are kept apart
+        rows = np.arange(len(hsc))
+        for alias, table in SQL_TABLES.items():
+            cols = [(name, expr.split('.')[1]) for name, expr in SQL_COLUMNS.items()
+                    if expr.split('.')[0] == alias]
+            db.execute(f"CREATE TABLE {table} (object_id INTEGER PRIMARY KEY, "
+                       f"{', '.join(col for _, col in cols)})")
+            values = [rows.tolist()] + [_sqlite_values(hsc[name]) for name, _ in cols]
+            db.executemany(f"INSERT INTO {table} VALUES ({', '.join(['?'] * len(values))})",
+                           zip(*values))
+
+        tables = list(SQL_TABLES.items())
+        query = f"SELECT {tables[0][0]}.object_id FROM {tables[0][1]} AS {tables[0][0]}\n"
+        query += '\n'.join(f"LEFT JOIN {table} AS {alias} USING (object_id)"
+                           for alias, table in tables[1:])
+        query += '\nWHERE ' + '\n AND '.join(conds)
+        in_prefilter[[row for row, in db.execute(query)]] = True
+        db.close()
+
+    # targets that do not pass the pre-filter (isCosmology works row by row
+    # so selecting from the pre-filtered objects gives the same targets)
+    objects = Cuts._prepare_hsc(hsc, dust_extinction=dust_extinction,
+                                release=release, zeropoint=zeropoint, cache=False)
+    is_target = Cuts.isCosmology(objects, **kwargs)
+
+    nlost = int(np.sum(is_target & ~in_prefilter))
+    return in_prefilter, nlost
+
+
+def _max_zeropoint_offset(release='s23b'):
+    ''' largest |zero-point offset| of the g, r, i, and z bands that is not a
+    sentinel (see SENTINEL_OFFSET)
+    '''
+    names, tracts = E._zeropoint_lines(release)
+    cols = [names.index(f'{b}_mag_offset') for b in 'griz']
+    offsets = np.abs([[float(line.split(',')[i] or 0.) for i in cols]
+                      for lines in tracts.values() for line in lines])
+    return float(np.max(offsets[offsets < SENTINEL_OFFSET], initial=0.))
+
+
+def _cosmology_params(**kwargs):
+    ''' parameters of `cuts.isCosmology` (defaults updated with kwargs)
+    '''
+    params = {name: par.default for name, par in
+              inspect.signature(Cuts.isCosmology).parameters.items()
+              if par.default is not inspect.Parameter.empty}
+    for name in kwargs:
+        if name not in params:
+            raise TypeError(f"isCosmology got an unexpected keyword argument '{name}'")
+    params.update(kwargs)
+    return params
+
+
+def _f(x):
+    ''' format number for SQL
+    '''
+    return repr(round(float(x), 6))
+
+
+def _sqlite_values(column):
+    ''' convert column to a list of python values for sqlite (masked and
+    non-finite values are stored as NULL)
+    '''
+    column = np.ma.asarray(column)
+    values = column.filled(0).tolist()
+    null = np.ma.getmaskarray(column)
+    if column.dtype.kind == 'f':
+        null = null | ~np.isfinite(column.filled(0))
+    return [None if _null else value for value, _null in zip(values, null)]
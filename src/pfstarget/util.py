@@ -1,30 +1,195 @@
 import os
 import numpy as np 
-from astropy.table import Table, join
 
 
-def healpixelize(ra, dec, nside=128): 
-    ''' given RA and Dec return healpix number count. This is to calculate
-    target/random counts
+# nside of the NESTED healpix pixel computed once per object (see `hpx_pixel`).
+# Pixels at all coarser resolutions are derived from it with `degrade_pixel`.
+HPX_NSIDE = 2**16
+
+
+def hpx_pixel(ra, dec, nside=HPX_NSIDE): 
+    ''' given RA and Dec (in degrees) return the high resolution NESTED healpix
+    pixel. This is the only place where angles are converted to pixels. 
+
+    This is `healpy.ang2pix(nside, ra, dec, nest=True, lonlat=True)` (the
+    loc2pix of the healpix C++ library, operation by operation) in numpy so
+    that the target selection does not need to import healpy. 
+    '''
+    check_nside(nside) 
+    theta = np.pi / 2. - np.radians(np.asarray(dec, dtype=float)) 
+    phi = np.radians(np.asarray(ra, dtype=float)) 
+    if not np.all((theta >= 0) & (theta <= np.pi)): 
+        raise ValueError("Dec is not within [-90, 90]") 
+
+    order = int(nside).bit_length() - 1 
+    z = np.cos(theta) 
+    za = np.abs(z) 
+    # phi / (pi/2) in [0, 4) 
+    tt = np.fmod(phi * 0.6366197723675813430755350534900574, 4.) 
+    tt = np.where(tt < 0, tt + 4., tt) 
+    tt[tt == 4.] = 0. 
+
+    ix = np.zeros(theta.shape, dtype=np.int64) 
+    iy = np.zeros(theta.shape, dtype=np.int64) 
+    face = np.zeros(theta.shape, dtype=np.int64) 
+
+    # equatorial region 
+    eq = (za <= 2. / 3.) 
+    temp1 = nside * (0.5 + tt[eq]) 
+    temp2 = nside * (z[eq] * 0.75) 
+    jp = (temp1 - temp2).astype(np.int64) # index of ascending edge line 
+    jm = (temp1 + temp2).astype(np.int64) # index of descending edge line 
+    ifp, ifm = jp >> order, jm >> order 
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8)) 
+    ix[eq] = jm & (nside - 1) 
+    iy[eq] = nside - (jp & (nside - 1)) - 1 
+
+    # polar regions 
+    pl = ~eq 
+    ntt = np.minimum(3, tt[pl].astype(np.int64)) 
+    tp = tt[pl] - ntt 
+    _theta, _za = theta[pl], za[pl] 
+    # close to the poles sin(theta) is more precise than 1 - |z| 
+    near_pole = (_theta < 0.01) | (_theta > 3.14159 - 0.01) 
+    tmp = np.where((_za < 0.99) | ~near_pole, 
+                   nside * np.sqrt(3 * (1 - _za)), 
+                   nside * np.sin(_theta) / np.sqrt((1. + _za) / 3.)) 
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1) # increasing edge line 
+    jm = np.minimum(((1.0 - tp) * tmp).astype(np.int64), nside - 1) # decreasing edge line 
+    north = (z[pl] > 0) 
+    face[pl] = np.where(north, ntt, ntt + 8) 
+    ix[pl] = np.where(north, nside - jm - 1, jp) 
+    iy[pl] = np.where(north, nside - jp - 1, jm) 
+
+    hpix = (face << (2 * order)) + _spread_bits(ix) + (_spread_bits(iy) << 1) 
+    return hpix if hpix.ndim > 0 else int(hpix) 
+
+
+def check_nside(nside, nside_max=2**29): 
+    ''' raise ValueError if nside is not a valid healpix nside (a power of 2
+    that is at most nside_max) 
+    '''
+    if int(nside) != nside or nside < 1 or (int(nside) & (int(nside) - 1)) != 0: 
+        raise ValueError(f"nside {nside} is not a power of 2")
+    if nside > nside_max: 
+        raise ValueError(f"nside {nside} is larger than {nside_max}")
+
+
+def degrade_pixel(hpix, nside, nside_in=HPX_NSIDE): 
+    ''' given NESTED healpix pixels at nside_in return the NESTED pixels at a
+    coarser nside. In the NESTED scheme this is a bit shift. 
+    '''
+    check_nside(nside_in) 
+    check_nside(nside, nside_max=nside_in) 
+
+    shift = 2 * (int(nside_in).bit_length() - int(nside).bit_length())
+    return np.asarray(hpix, dtype=np.int64) >> shift
+
+
+def _spread_bits(v): 
+    ''' interleave the bits of v with zeros (bit i of v is bit 2i of the
+    output) 
+    '''
+    v = np.asarray(v, dtype=np.int64) & 0xFFFFFFFF 
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF 
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF 
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F 
+    v = (v | (v << 2)) & 0x3333333333333333 
+    v = (v | (v << 1)) & 0x5555555555555555 
+    return v 
+
+
+def _compress_bits(v): 
+    ''' inverse of `_spread_bits` for the even bits of v 
+    '''
+    v = np.asarray(v, dtype=np.int64) & 0x5555555555555555 
+    v = (v | (v >> 1)) & 0x3333333333333333 
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F 
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF 
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF 
+    v = (v | (v >> 16)) & 0x00000000FFFFFFFF 
+    return v 
+
+
+def healpix_counts(hpix, nside=128, nside_in=HPX_NSIDE): 
+    ''' given high resolution NESTED healpix pixels (e.g. the HPXPIXEL column
+    of `cuts._prepare_hsc`) return healpix number count at nside (RING) 
     '''
-    import healpy as hp 
     # total number of pixels
-    npix = hp.nside2npix(nside)  
-    
-    hpix = hp.ang2pix(nside, 
-                      np.radians(90.0 - dec), 
-                      np.radians(ra))
+    npix = 12 * nside**2 
 
-    uhpix, nhpix = np.unique(hpix, return_counts=True)
+    uhpix, nhpix = np.unique(degrade_pixel(hpix, nside, nside_in=nside_in), 
+                             return_counts=True)
     hp_map = np.zeros(npix)
-    hp_map[uhpix] = nhpix
+    hp_map[nest2ring(nside, uhpix)] = nhpix
 
     return hp_map 
 
 
+def nest2ring(nside, ipnest): 
+    ''' convert NESTED healpix pixels to RING pixels. This is
+    `healpy.nest2ring` (the nest2ring of the healpix C++ library) in numpy. 
+    '''
+    check_nside(nside) 
+    ipnest = np.asarray(ipnest, dtype=np.int64) 
+    order = int(nside).bit_length() - 1 
+    nl4 = 4 * nside 
+    npix = 12 * nside**2 
+    ncap = 2 * nside * (nside - 1) 
+
+    face = ipnest >> (2 * order) 
+    ipf = ipnest & (nside**2 - 1) 
+    ix, iy = _compress_bits(ipf), _compress_bits(ipf >> 1) 
+
+    # ring index (1 at the north pole) 
+    jr = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])[face] * nside - ix - iy - 1 
+    north, south = (jr < nside), (jr > 3 * nside) 
+    nr = np.where(north, jr, np.where(south, nl4 - jr, nside)) 
+    n_before = np.where(north, 2 * nr * (nr - 1), 
+                        np.where(south, npix - 2 * (nr + 1) * nr, ncap + (jr - nside) * nl4)) 
+    kshift = np.where(north | south, 0, (jr - nside) & 1) 
+
+    # pixel index within the ring (C integer division truncates towards 0) 
+    num = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])[face] * nr + ix - iy + 1 + kshift 
+    jp = np.where(num < 0, -(-num // 2), num // 2) 
+    jp = np.where(jp > nl4, jp - nl4, np.where(jp < 1, jp + nl4, jp)) 
+    return n_before + jp - 1 
+
+
+def healpixelize(ra, dec, nside=128): 
+    ''' given RA and Dec return healpix number count. This is to calculate
+    target/random counts
+    '''
+    return healpix_counts(hpx_pixel(ra, dec), nside=nside)
+
+
+def shard_files(files, ishard, nshard): 
+    ''' split a list of files into `nshard` shards balanced by total file size
+    and return the files in shard `ishard`. Files are assigned largest first to
+    the shard with the smallest total size so the split only depends on the
+    file names and sizes. 
+    '''
+    if not (0 <= ishard < nshard): 
+        raise ValueError(f"shard {ishard} not in 0..{nshard-1}")
+
+    sizes = [os.path.getsize(f) for f in files]
+    # largest files first; ties broken by file name 
+    order = sorted(range(len(files)), 
+                   key=lambda i: (-sizes[i], os.path.basename(files[i])))
+
+    totals = np.zeros(nshard, dtype=np.int64)
+    shard = [] 
+    for i in order: 
+        j = int(np.argmin(totals)) 
+        totals[j] += sizes[i]
+        if j == ishard: shard.append(files[i])
+    return sorted(shard, key=os.path.basename) 
+
+
 def patch_qa(tract, patch, release='s23b'): 
     if release != 's23b': 
         raise NotImplementedError("patch_qa only for S23B")
+    from astropy.table import Table, join
     
     # read pdr3_wide.patch_qa
     fpatch = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import pytest
+
+from pfstarget import cache as C
+
+
+HSC_DTYPE = [(col, '<f8') for col in C.HSC_COLUMNS]
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('PFSTARGET_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.delenv('PFSTARGET_CACHE_SIZE', raising=False)
+    monkeypatch.setattr(C, '_cache_size', {})
+    return C.cache_dir()
+
+
+def test_cache_hit(cache_dir):
+    data = np.arange(10, dtype=np.float32).reshape(5, 2)
+    assert C.load('key') is None
+    C.save('key', data)
+    assert np.array_equal(C.load('key'), data)
+    assert os.listdir(cache_dir) == ['key.npy']
+
+
+def test_cache_key(tmp_path):
+    hsc = np.zeros(3, dtype=HSC_DTYPE)
+    key = C.cache_key(hsc)
+    assert key == C.cache_key(hsc.copy())
+    assert key != C.cache_key(hsc, dust_extinction='desi')
+    assert key != C.cache_key(hsc, zeropoint=False)
+
+    # changes of the input columns change the column hash
+    _hsc = hsc.copy()
+    _hsc['g_cmodel_mag'][0] = 1.
+    assert key != C.cache_key(_hsc)
+
+    # with a tract file the key follows the file and not the columns
+    ftract = tmp_path / 'tract.fits'
+    ftract.write_bytes(b'tract')
+    key = C.cache_key(hsc, tract_file=str(ftract))
+    assert key == C.cache_key(_hsc, tract_file=str(ftract))
+    ftract.write_bytes(b'tract, modified')
+    assert key != C.cache_key(hsc, tract_file=str(ftract))
+
+
+def test_cache_version(monkeypatch):
+    hsc = np.zeros(3, dtype=HSC_DTYPE)
+    key = C.cache_key(hsc)
+    monkeypatch.setattr(C, 'CACHE_VERSION', C.CACHE_VERSION + 1)
+    assert key != C.cache_key(hsc)
+
+
+def test_cache_eviction(cache_dir):
+    data = np.zeros(100, dtype=np.float32)
+    for i in range(5):
+        C.save(f'key{i}', data, max_size=1200)
+        # entries are evicted by modification time
+        os.utime(os.path.join(cache_dir, f'key{i}.npy'), (i, i))
+    # two entries (~500 bytes each) fit
+    assert sorted(os.listdir(cache_dir)) == ['key3.npy', 'key4.npy']
+
+    # loading marks an entry as recently used
+    C.load('key3')
+    C.save('key5', data, max_size=1200)
+    assert sorted(os.listdir(cache_dir)) == ['key3.npy', 'key5.npy']
+
+    C.clear()
+    assert os.listdir(cache_dir) == []
+
+
+def test_cache_not_writable(tmp_path, monkeypatch):
+    # the cache directory cannot be created below a file
+    (tmp_path / 'file').write_text('')
+    monkeypatch.setenv('PFSTARGET_CACHE_DIR', str(tmp_path / 'file'))
+    monkeypatch.setattr(C, '_cache_size', {})
+    C.save('key', np.zeros(3))
+    assert C.load('key') is None
+
+
+def test_cache_disabled(monkeypatch):
+    monkeypatch.setenv('PFSTARGET_CACHE_DIR', '')
+    assert C.cache_dir() is None
+    C.save('key', np.zeros(3))
+    assert C.load('key') is None
+
+
+@pytest.mark.parametrize('size, max_size', [('2e9', 2000000000), ('1000', 1000),
+                                            ('2GB', C.MAX_SIZE), (None, C.MAX_SIZE)])
+def test_max_cache_size(monkeypatch, size, max_size):
+    if size is None:
+        monkeypatch.delenv('PFSTARGET_CACHE_SIZE', raising=False)
+    else:
+        monkeypatch.setenv('PFSTARGET_CACHE_SIZE', size)
+    assert C.max_cache_size() == max_size
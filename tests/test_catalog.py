@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+
+from pfstarget import catalog as C
+
+
+def _runs(nruns, nrows, nobjid=None, seed=0):
+    ''' runs sorted by OBJID with objects that appear in more than one run
+    '''
+    rng = np.random.default_rng(seed)
+    if nobjid is None: nobjid = 2 * nruns * nrows
+    runs = []
+    for i in range(nruns):
+        run = np.zeros(nrows, dtype=[('OBJID', '<i8'), ('RUN', '<i4'), ('ROW', '<i4')])
+        run['OBJID'] = np.sort(rng.choice(nobjid, size=nrows, replace=False))
+        run['RUN'] = i
+        run['ROW'] = np.arange(nrows)
+        runs.append(run)
+    return runs
+
+
+def _merge(runs, **kwargs):
+    chunks, ndropped = [], np.zeros(len(runs), dtype=int)
+    for chunk, n in C.merge_unique(runs, **kwargs):
+        chunks.append(chunk)
+        ndropped += n
+    return chunks, ndropped
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 1000000])
+def test_merge_unique(chunk_size):
+    runs = _runs(5, 300)
+    chunks, ndropped = _merge(runs, chunk_size=chunk_size)
+    merged = np.concatenate(chunks)
+
+    # brute force: the first occurrence of each OBJID is from the earliest run
+    _all = np.concatenate(runs)
+    _, i_first = np.unique(_all['OBJID'], return_index=True)
+    assert np.array_equal(merged, _all[i_first])
+    assert np.array_equal(ndropped, [300 - np.sum(merged['RUN'] == i) for i in range(5)])
+
+
+def test_merge_unique_memory():
+    # many runs that are each much smaller than the budget
+    runs = _runs(200, 5000)
+    chunk_size = 100000
+    chunks, _ = _merge(runs, chunk_size=chunk_size)
+    assert max(len(chunk) for chunk in chunks) <= chunk_size
+    assert sum(len(chunk) for chunk in chunks) == len(np.unique(np.concatenate(runs)['OBJID']))
+
+
+def test_merge_unique_unsorted():
+    runs = _runs(2, 10)
+    runs[1] = runs[1][::-1]
+    with pytest.raises(ValueError):
+        _merge(runs, chunk_size=4)
+
+
+def _catalog(n=5000, seed=0):
+    ''' catalog of objects in a ~20x10 deg region
+    '''
+    from pfstarget import util as U
+    rng = np.random.default_rng(seed)
+    objects = np.zeros(n, dtype=[('OBJID', '<i8'), ('RA', '<f4'), ('DEC', '<f4'),
+                                 ('HPXPIXEL', '<i8'), ('I_MAG', '<f4'), ('FLAG', bool)])
+    objects['OBJID'] = rng.permutation(n)
+    objects['RA'] = rng.uniform(130., 150., n)
+    objects['DEC'] = rng.uniform(-5., 5., n)
+    objects['HPXPIXEL'] = U.hpx_pixel(objects['RA'], objects['DEC'])
+    objects['I_MAG'] = rng.uniform(20., 25., n)
+    objects['FLAG'] = rng.integers(0, 2, n).astype(bool)
+    return objects
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1000000])
+def test_write_partitioned(tmp_path, chunk_size):
+    from pfstarget import util as U
+    objects = _catalog()
+    dest = str(tmp_path / 'catalog')
+    index = C.write_partitioned(objects, dest, nside=16, chunk_size=chunk_size)
+    assert index['nrows'] == sum(index['partitions'].values()) == len(objects)
+
+    # all objects are read back; within a partition in the input order
+    _objects = C.read_partitioned(dest)
+    assert _objects.dtype == objects.dtype
+    hpix = U.degrade_pixel(objects['HPXPIXEL'], 16)
+    assert np.array_equal(_objects, objects[np.argsort(hpix, kind='stable')])
+
+    # subsets of pixels and columns
+    pix = sorted(C.read_index(dest)['partitions'])[:2]
+    _objects = C.read_partitioned(dest, columns=['OBJID', 'I_MAG'], pixels=pix)
+    assert _objects.dtype.names == ('OBJID', 'I_MAG')
+    assert np.array_equal(np.sort(_objects['OBJID']), np.sort(objects['OBJID'][np.isin(hpix, pix)]))
+
+
+def test_write_partitioned_overwrite(tmp_path):
+    objects = _catalog(n=100)
+    dest = str(tmp_path / 'catalog')
+    C.write_partitioned(objects, dest)
+    with pytest.raises(ValueError):
+        C.write_partitioned(objects, dest)
+    C.write_partitioned(objects[:10], dest, overwrite=True)
+    assert C.read_index(dest)['nrows'] == 10
+
+    # directories that are not partitioned catalogs are never removed
+    (tmp_path / 'other').mkdir()
+    (tmp_path / 'other' / 'data.txt').write_text('keep')
+    with pytest.raises(ValueError):
+        C.write_partitioned(objects, str(tmp_path / 'other'), overwrite=True)
+    assert (tmp_path / 'other' / 'data.txt').exists()
+
+
+def test_query_disc(tmp_path):
+    pytest.importorskip('healpy')
+    objects = _catalog()
+    dest = str(tmp_path / 'catalog')
+    C.write_partitioned(objects, dest, nside=32)
+
+    _objects = C.query_disc(dest, 140., 0., 2., columns=['OBJID'])
+    assert _objects.dtype == np.dtype([('OBJID', '<i8')])
+    in_disc = (C._angular_separation(140., 0., objects['RA'], objects['DEC']) <= 2.)
+    assert np.array_equal(np.sort(_objects['OBJID']), np.sort(objects['OBJID'][in_disc]))
+
+
+@pytest.mark.parametrize('nrows, chunk_size', [(0, 10), (1, 10), (5000, 7), (5000, 1000000)])
+def test_write_fits(tmp_path, nrows, chunk_size):
+    Table = pytest.importorskip('astropy.table').Table
+    objects = _catalog(n=5000)[:nrows]
+    fref, fout = str(tmp_path / 'ref.fits'), str(tmp_path / 'out.fits')
+    Table(objects).write(fref)
+    C._write_fits(objects, fout, chunk_size=chunk_size)
+    with open(fref, 'rb') as f0, open(fout, 'rb') as f1:
+        assert f0.read() == f1.read()
+
+    # existing files are overwritten
+    C._write_fits(objects, fout, chunk_size=chunk_size)
+    with open(fref, 'rb') as f0, open(fout, 'rb') as f1:
+        assert f0.read() == f1.read()
+
+
+def test_merge_shards(tmp_path):
+    runs = _runs(6, 200)
+    for ishard in range(2):
+        path = tmp_path / f'shard{ishard}'
+        (path / 'runs').mkdir(parents=True)
+        files = []
+        for i in range(ishard, 6, 2):
+            np.save(path / 'runs' / f'{i}.npy', runs[i])
+            files.append({'file': f'tract{i}.fits', 'run': f'runs/{i}.npy'})
+        C.write_manifest(str(path), {'shard': ishard, 'nshard': 2, 'dust': 'sfd98',
+                                     'nside_map': 128, 'files': files, 'randoms': None})
+
+    targets, ndropped, randoms = C.merge_shards(
+            [str(tmp_path / 'shard1'), str(tmp_path / 'shard0')], str(tmp_path / 'merged.npy'),
+            chunk_size=50)
+    merged, _ndropped = _merge(runs)
+    assert np.array_equal(targets, np.concatenate(merged))
+    assert ndropped == {f'tract{i}.fits': int(n) for i, n in enumerate(_ndropped)}
+    assert randoms is None
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from pfstarget import util as U
+
+hp = pytest.importorskip('healpy')
+
+
+def _points(nside, n=200000, seed=0):
+    ''' random points, points close to the poles, and points on the corners
+    and at the centers of the pixels
+    '''
+    rng = np.random.default_rng(seed)
+    ra = np.concatenate([rng.uniform(-360., 720., n), rng.uniform(0., 360., n // 10),
+                         [0., 90., 180., 270., 360., 45., -45.]])
+    dec = np.concatenate([np.degrees(np.arcsin(rng.uniform(-1., 1., n))),
+                          rng.choice([-1., 1.], n // 10) * (90. - rng.uniform(0., 1., n // 10)**4),
+                          [90., -90., 0., 41.8103149, -41.8103149, 89.99999, -89.99999]])
+
+    pix = rng.integers(0, 12 * min(nside, 1024)**2, 2000)
+    _nside = min(nside, 1024)
+    corners = hp.boundaries(_nside, pix, step=1, nest=True)
+    _ra, _dec = hp.vec2ang(np.moveaxis(corners, 1, 2).reshape(-1, 3), lonlat=True)
+    ra_c, dec_c = hp.pix2ang(_nside, pix, nest=True, lonlat=True)
+    return np.concatenate([ra, _ra, ra_c]), np.concatenate([dec, _dec, dec_c])
+
+
+@pytest.mark.parametrize('nside', [1, 2, 32, 512, U.HPX_NSIDE, 2**29])
+def test_hpx_pixel(nside):
+    ra, dec = _points(nside)
+    assert np.array_equal(U.hpx_pixel(ra, dec, nside=nside),
+                          hp.ang2pix(nside, ra, dec, nest=True, lonlat=True))
+
+
+def test_hpx_pixel_scalar():
+    assert U.hpx_pixel(150., 2.) == hp.ang2pix(U.HPX_NSIDE, 150., 2., nest=True, lonlat=True)
+
+
+def test_degrade_pixel():
+    ra, dec = _points(128, n=10000)
+    hpix = U.hpx_pixel(ra, dec)
+    for nside in [1, 32, 128]:
+        assert np.array_equal(U.degrade_pixel(hpix, nside),
+                              hp.ang2pix(nside, ra, dec, nest=True, lonlat=True))
+    with pytest.raises(ValueError):
+        U.degrade_pixel(hpix, 100)
+
+
+@pytest.mark.parametrize('nside', [1, 2, 4, 64, 1024])
+def test_nest2ring(nside):
+    ipnest = np.arange(12 * nside**2)
+    assert np.array_equal(U.nest2ring(nside, ipnest), hp.nest2ring(nside, ipnest))
+
+
+def test_healpix_counts():
+    ra, dec = _points(64, n=10000)
+    hpix = hp.nest2ring(64, hp.ang2pix(64, ra, dec, nest=True, lonlat=True))
+    assert np.array_equal(U.healpix_counts(U.hpx_pixel(ra, dec), nside=64),
+                          np.bincount(hpix, minlength=12 * 64**2))